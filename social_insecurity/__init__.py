@@ -8,6 +8,7 @@ from shutil import rmtree
 from typing import cast
 
 from flask import Flask, current_app
+from flask_caching import Cache
 
 from social_insecurity.config import Config
 from social_insecurity.database import SQLite3
@@ -17,6 +18,7 @@ from social_insecurity.database import SQLite3
 # from flask_wtf.csrf import CSRFProtect
 
 sqlite = SQLite3()
+cache = Cache()
 # TODO: Handle login management better, maybe with flask_login?
 # login = LoginManager()
 # TODO: The passwords are stored in plaintext, this is not secure at all. I should probably use bcrypt or something
@@ -29,10 +31,14 @@ def create_app(test_config=None) -> Flask:
     """Create and configure the Flask application."""
     app = Flask(__name__)
     app.config.from_object(Config)
-    if test_config:
+    if isinstance(test_config, dict):
+        app.config.from_mapping(test_config)
+    elif test_config:
         app.config.from_object(test_config)
+    app.config["_UPLOADS_DIR"] = str(Path(app.instance_path) / cast(str, app.config["UPLOADS_FOLDER_PATH"]))
 
-    sqlite.init_app(app, schema="schema.sql")
+    sqlite.init_app(app, schema="schema.sql", migrations="migrations.sql")
+    cache.init_app(app)
     # login.init_app(app)
     # bcrypt.init_app(app)
     # csrf.init_app(app)
@@ -55,6 +61,6 @@ def create_app(test_config=None) -> Flask:
 
 def create_uploads_folder(app: Flask) -> None:
     """Create the instance and upload folders."""
-    upload_path = Path(app.instance_path) / cast(str, app.config["UPLOADS_FOLDER_PATH"])
+    upload_path = Path(app.config["_UPLOADS_DIR"])
     if not upload_path.exists():
         upload_path.mkdir(parents=True)
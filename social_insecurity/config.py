@@ -19,12 +19,21 @@ import os
 class Config:
     SECRET_KEY = os.environ.get("SECRET_KEY") or "FK0kZokVorHtu29BfrT7JuQuljKFqAcH"  # TODO: Use this with wtforms
     SQLITE3_DATABASE_PATH = "sqlite3.db"  # Path relative to the Flask instance folder
+    SQLITE3_POOL_SIZE = 5  # Number of connections kept open between requests
+    CACHE_TYPE = "SimpleCache"  # Use "RedisCache" with CACHE_REDIS_URL when running several workers
+    CACHE_DEFAULT_TIMEOUT = 30  # Seconds a cached feed, comment thread or friend list is served
     UPLOADS_FOLDER_PATH = "uploads"  # Path relative to the Flask instance folder
-    ALLOWED_EXTENSIONS = {".jpeg", ".jpg", ".gif", ".png", ".webp"}
+    UPLOADS_MAX_AGE = 86400  # Uploads are never modified, so browsers may cache them for a day
+    USE_X_SENDFILE = os.environ.get("USE_X_SENDFILE") == "1"  # Let nginx/Apache send uploads when behind one
+    ALLOWED_EXTENSIONS = frozenset({"jpeg", "jpg", "gif", "png", "webp"})  # Lowercase, without the leading dot
     WTF_CSRF_ENABLED = False  # TODO: I should probably implement this wtforms feature, but it's not a priority
+    POSTS_PER_PAGE = 20
+    COMMENTS_PER_PAGE = 20
     COOLDOWN_MS = 1000
     UPLOAD_LIMIT = 5
     UPLOAD_WINDOW = 60
     MAX_LOGIN_ATTEMPTS = 5
     LOGIN_COOLDOWN = 3600 # 1 hour
+    PASSWORD_HASH_WORKERS = os.cpu_count() or 1  # Max number of password hashes computed at once
+    RATE_LIMIT_CACHE_SIZE = 10_000  # Max number of users/IPs tracked by each rate limiter
     MAX_CONTENT_LENGTH = 1024 * 1024 # 1 MB
\ No newline at end of file
@@ -15,10 +15,81 @@ from __future__ import annotations
 import sqlite3
 from os import PathLike
 from pathlib import Path
+from queue import Empty, Full, LifoQueue
 from typing import Any, Optional, cast
 
 from flask import Flask, current_app, g
 
+# Applied to every new connection. WAL lets readers proceed while a write is in progress,
+# and synchronous=NORMAL is durable in WAL mode while skipping an fsync per commit.
+_PRAGMAS = """
+    PRAGMA journal_mode = WAL;
+    PRAGMA synchronous = NORMAL;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA cache_size = -20000;
+    PRAGMA mmap_size = 268435456;
+    PRAGMA foreign_keys = ON;
+"""
+
+# Queries are module constants so every call passes identical SQL text to the connection's statement cache.
+_Q_USER_DATA_BY_ID = (
+    "SELECT username, id, first_name, last_name, education, employment, music, movie, nationality, birthday "
+    "FROM Users WHERE id = ?"
+)
+_Q_USER_DATA_BY_USERNAME = (
+    "SELECT username, id, first_name, last_name, education, employment, music, movie, nationality, birthday "
+    "FROM Users WHERE username = ?"
+)
+_Q_USER_AUTH = "SELECT id, password FROM Users WHERE username = ?"
+_Q_POST = "SELECT * FROM Posts AS p JOIN Users AS u ON p.u_id = u.id WHERE p.id = ?"
+_Q_POSTS = """
+    WITH feed_uids AS (
+        SELECT f_id AS uid FROM Friends WHERE u_id = :u_id
+        UNION SELECT u_id FROM Friends WHERE f_id = :u_id
+        UNION SELECT :u_id
+    ),
+    page AS (
+        SELECT p.id, p.u_id, p.content, p.image, p.creation_time
+        FROM Posts AS p JOIN feed_uids AS fu ON fu.uid = p.u_id
+        WHERE :before_ts IS NULL OR (p.creation_time, p.id) < (:before_ts, :before_id)
+        ORDER BY p.creation_time DESC, p.id DESC
+        LIMIT :limit
+    )
+    SELECT page.*, u.username, u.first_name, u.last_name,
+        (SELECT COUNT(*) FROM Comments AS c WHERE c.p_id = page.id) AS cc
+    FROM page JOIN Users AS u ON u.id = page.u_id
+    ORDER BY page.creation_time DESC, page.id DESC
+"""
+_Q_COMMENTS = """
+    SELECT c.id, c.comment, c.creation_time, u.username, u.first_name, u.last_name
+    FROM Comments AS c JOIN Users AS u ON c.u_id = u.id
+    WHERE c.p_id = :p_id AND (:before_ts IS NULL OR (c.creation_time, c.id) < (:before_ts, :before_id))
+    ORDER BY c.creation_time DESC, c.id DESC
+    LIMIT :limit
+"""
+_Q_FRIENDS = "SELECT * FROM Friends WHERE u_id = ?"
+_Q_FRIEND_DATAS = (
+    "SELECT f.u_id, f.f_id, u.username, u.first_name, u.last_name "
+    "FROM Friends AS f JOIN Users as u ON f.f_id = u.id WHERE f.u_id = ? AND f.f_id != ?"
+)
+_Q_CREATE_USER = "INSERT INTO Users (username, first_name, last_name, password) VALUES (?, ?, ?, ?)"
+_Q_CREATE_POST = "INSERT INTO Posts (u_id, content, image, creation_time) VALUES (?, ?, ?, CURRENT_TIMESTAMP)"
+_Q_CREATE_COMMENT = "INSERT INTO Comments (p_id, u_id, comment, creation_time) VALUES (?, ?, ?, CURRENT_TIMESTAMP)"
+_Q_UPDATE_PROFILE = (
+    "UPDATE Users SET education = ?, employment = ?, music = ?, movie = ?, nationality = ?, birthday = ? "
+    "WHERE username = ?"
+)
+_Q_ADD_FRIEND = "INSERT OR IGNORE INTO Friends (u_id, f_id) VALUES (?, ?)"
+# Foreign keys are enforced, so rows referencing Users have to go first
+_Q_DELETE_ALL_USERS = """
+    BEGIN IMMEDIATE;
+    DELETE FROM Comments;
+    DELETE FROM Friends;
+    DELETE FROM Posts;
+    DELETE FROM Users;
+    COMMIT;
+"""
+
 
 class SQLite3:
     """Provides a SQLite3 database extension for Flask.
@@ -45,6 +116,7 @@ class SQLite3:
         *,
         path: Optional[PathLike | str] = None,
         schema: Optional[PathLike | str] = None,
+        migrations: Optional[PathLike | str] = None,
     ) -> None:
         """Initializes the extension.
 
@@ -52,10 +124,11 @@ class SQLite3:
             app: The Flask application to initialize the extension with.
             path (optional): The path to the database file. Is relative to the instance folder.
             schema (optional): The path to the schema file. Is relative to the application root folder.
+            migrations (optional): The path to the migrations file. Is relative to the application root folder.
 
         """
         if app is not None:
-            self.init_app(app, path=path, schema=schema)
+            self.init_app(app, path=path, schema=schema, migrations=migrations)
 
     def init_app(
         self,
@@ -63,6 +136,7 @@ class SQLite3:
         *,
         path: Optional[PathLike | str] = None,
         schema: Optional[PathLike | str] = None,
+        migrations: Optional[PathLike | str] = None,
     ) -> None:
         """Initializes the extension.
 
@@ -70,6 +144,7 @@ class SQLite3:
             app: The Flask application to initialize the extension with.
             path (optional): The path to the database file. Is relative to the instance folder.
             schema (optional): The path to the schema file. Is relative to the application root folder.
+            migrations (optional): The path to the migrations file. Is relative to the application root folder.
 
         """
         if not hasattr(app, "extensions"):
@@ -94,19 +169,34 @@ class SQLite3:
         if not self._path.exists():
             self._path.parent.mkdir(parents=True)
 
+        self._pool: LifoQueue[sqlite3.Connection] = LifoQueue(maxsize=app.config.get("SQLITE3_POOL_SIZE", 5))
+        app.teardown_appcontext(self._close_connection)
+
         if schema and not self._path.exists():
             with app.app_context():
                 self._init_database(schema)
+        elif migrations:
+            with app.app_context():
+                self._migrate_database(migrations)
 
-        app.teardown_appcontext(self._close_connection)
+        # The pool fills lazily from the first requests. Connections must not survive a fork into
+        # server workers (e.g. gunicorn --preload), so close the one used to set up the database.
+        self._close_pool()
 
     @property
     def connection(self) -> sqlite3.Connection:
-        """Returns the connection to the SQLite3 database."""
+        """Returns the connection to the SQLite3 database.
+
+        The connection is taken from the pool on first access in an application context,
+        and returned to the pool when the context is torn down.
+        """
         conn = getattr(g, "flask_sqlite3_connection", None)
         if conn is None:
-            conn = g.flask_sqlite3_connection = sqlite3.connect(self._path)
-            conn.row_factory = sqlite3.Row
+            try:
+                conn = self._pool.get_nowait()
+            except Empty:
+                conn = self._connect()
+            g.flask_sqlite3_connection = conn
         return conn
 
     def get_user_data(self, username: Optional[str] = None, id: Optional[int] = None) -> Optional[dict]:
@@ -115,16 +205,13 @@ class SQLite3:
         response = None
 
         if id is not None:
-            query = "SELECT username, id, first_name, last_name, education, employment, music, movie, nationality, birthday FROM Users WHERE id = ?"
-            cursor = self.connection.execute(query, (id,))
+            cursor = self.connection.execute(_Q_USER_DATA_BY_ID, (id,))
             response = cursor.fetchone()
         else:
-            query = "SELECT username, id, first_name, last_name, education, employment, music, movie, nationality, birthday FROM Users WHERE username = ?"
-            cursor = self.connection.execute(query, (username,))
+            cursor = self.connection.execute(_Q_USER_DATA_BY_USERNAME, (username,))
             response = cursor.fetchone()
 
         cursor.close()
-        self.connection.commit()
 
         if response is None or len(response) == 0:
             return None
@@ -133,118 +220,73 @@ class SQLite3:
 
         return user
 
-    def get_user_password(self, username: str) -> Optional[str]:
-        """Returns the password of the user with the given username from the database."""
+    def get_user_auth(self, username: str) -> Optional[tuple[int, str]]:
+        """Returns the id and password of the user with the given username from the database."""
 
-        query = "SELECT password FROM Users WHERE username = ?"
-
-        cursor = self.connection.execute(query, (username,))
+        cursor = self.connection.execute(_Q_USER_AUTH, (username,))
         response = cursor.fetchone()
         cursor.close()
-        self.connection.commit()
 
         if response is None or len(response) == 0:
             return None
 
-        return response[0]
-
-    def get_user_id(self, username: str) -> Optional[int]:
-        """Returns the id of the user with the given username from the database."""
-
-        query = "SELECT id FROM Users WHERE username = ?"
+        return response[0], response[1]
 
-        cursor = self.connection.execute(query, (username,))
+    def get_post(self, p_id) -> Optional[sqlite3.Row]:
+        cursor = self.connection.execute(_Q_POST, (p_id,))
         response = cursor.fetchone()
         cursor.close()
-        self.connection.commit()
 
         if response is None or len(response) == 0:
             return None
 
-        return response[0]
+        return response
 
-    def get_post(self, p_id) -> Optional[dict]:
-        query = "SELECT * FROM Posts AS p JOIN Users AS u ON p.u_id = u.id WHERE p.id = ?"
+    def get_posts(self, u_id, before_ts=None, before_id=None, limit=20) -> list[sqlite3.Row]:
+        """Returns a page of posts from the user and their friends, newest first.
 
-        cursor = self.connection.execute(query, (p_id,))
-        response = cursor.fetchone()
-        cursor.close()
-        self.connection.commit()
-
-        if response is None or len(response) == 0:
-            return None
-
-        post = dict(response)
-
-        return post
+        params:
+            u_id: The id of the user whose stream is returned.
+            before_ts (optional): The creation time of the last post on the previous page.
+            before_id (optional): The id of the last post on the previous page, breaks ties on creation time.
+            limit (optional): The maximum number of posts to return.
 
-    def get_posts(self, u_id) -> list[dict]:
-        query = """
-            SELECT p.*, u.*, (SELECT COUNT(*) FROM Comments WHERE p_id = p.id) AS cc
-            FROM Posts AS p JOIN Users AS u ON u.id = p.u_id
-            WHERE p.u_id IN (SELECT u_id FROM Friends WHERE f_id = ?) OR p.u_id IN (SELECT f_id FROM Friends WHERE u_id = ?) OR p.u_id = ?
-            ORDER BY p.creation_time DESC
         """
-
-        cursor = self.connection.execute(query, (u_id, u_id, u_id))
-        response = cursor.fetchall()
+        params = {"u_id": u_id, "before_ts": before_ts, "before_id": before_id, "limit": limit}
+        cursor = self.connection.execute(_Q_POSTS, params)
+        posts = cursor.fetchall()
         cursor.close()
-        self.connection.commit()
 
-        if response is None or len(response) == 0:
-            return []
+        return posts
 
-        posts = [dict(post) for post in response]
+    def get_comments(self, p_id, before_ts=None, before_id=None, limit=20) -> list[sqlite3.Row]:
+        """Returns a page of comments on the post, newest first.
 
-        return posts
+        params:
+            p_id: The id of the post whose comments are returned.
+            before_ts (optional): The creation time of the last comment on the previous page.
+            before_id (optional): The id of the last comment on the previous page, breaks ties on creation time.
+            limit (optional): The maximum number of comments to return.
 
-    def get_comments(self, p_id) -> list[dict]:
-        query = """
-            SELECT DISTINCT *
-            FROM Comments AS c JOIN Users AS u ON c.u_id = u.id
-            WHERE c.p_id=?
-            ORDER BY c.creation_time DESC
         """
-
-        cursor = self.connection.execute(query, (p_id,))
-        response = cursor.fetchall()
+        params = {"p_id": p_id, "before_ts": before_ts, "before_id": before_id, "limit": limit}
+        cursor = self.connection.execute(_Q_COMMENTS, params)
+        comments = cursor.fetchall()
         cursor.close()
-        self.connection.commit()
-
-        if response is None or len(response) == 0:
-            return []
-
-        comments = [dict(comment) for comment in response]
 
         return comments
 
-    def get_friends(self, u_id) -> list[dict]:
-        query = "SELECT * FROM Friends WHERE u_id = ?"
-
-        cursor = self.connection.execute(query, (u_id,))
-        response = cursor.fetchall()
+    def get_friends(self, u_id) -> list[sqlite3.Row]:
+        cursor = self.connection.execute(_Q_FRIENDS, (u_id,))
+        friends = cursor.fetchall()
         cursor.close()
-        self.connection.commit()
-
-        if response is None or len(response) == 0:
-            return []
-
-        friends = [dict(friend) for friend in response]
 
         return friends
 
-    def get_friend_datas(self, u_id) -> list[dict]:
-        query = "SELECT * FROM Friends AS f JOIN Users as u ON f.f_id = u.id WHERE f.u_id = ? AND f.f_id != ?"
-
-        cursor = self.connection.execute(query, (u_id, u_id))
-        response = cursor.fetchall()
+    def get_friend_datas(self, u_id) -> list[sqlite3.Row]:
+        cursor = self.connection.execute(_Q_FRIEND_DATAS, (u_id, u_id))
+        friends = cursor.fetchall()
         cursor.close()
-        self.connection.commit()
-
-        if response is None or len(response) == 0:
-            return []
-
-        friends = [dict(friend) for friend in response]
 
         return friends
 
@@ -252,11 +294,8 @@ class SQLite3:
         """Creates a new user in the database."""
 
         try:
-            query = "INSERT INTO Users (username, first_name, last_name, password) VALUES (?, ?, ?, ?)"
-
-            cursor = self.connection.execute(query, (username, first_name, last_name, password))
+            cursor = self.connection.execute(_Q_CREATE_USER, (username, first_name, last_name, password))
             cursor.close()
-            self.connection.commit()
 
             return True
 
@@ -266,11 +305,8 @@ class SQLite3:
 
     def create_post(self, u_id, content, image) -> bool:
         try:
-            query = "INSERT INTO Posts (u_id, content, image, creation_time) VALUES (?, ?, ?, CURRENT_TIMESTAMP)"
-
-            cursor = self.connection.execute(query, (u_id, content, image))
+            cursor = self.connection.execute(_Q_CREATE_POST, (u_id, content, image))
             cursor.close()
-            self.connection.commit()
 
             return True
 
@@ -280,11 +316,8 @@ class SQLite3:
 
     def create_comment(self, p_id, u_id, comment) -> bool:
         try:
-            query = "INSERT INTO Comments (p_id, u_id, comment, creation_time) VALUES (?, ?, ?, CURRENT_TIMESTAMP)"
-
-            cursor = self.connection.execute(query, (p_id, u_id, comment))
+            cursor = self.connection.execute(_Q_CREATE_COMMENT, (p_id, u_id, comment))
             cursor.close()
-            self.connection.commit()
 
             return True
 
@@ -294,11 +327,8 @@ class SQLite3:
 
     def update_profile(self, username, education, employment, music, movie, nationality, birthday) -> bool:
         try:
-            query = "UPDATE Users SET education = ?, employment = ?, music = ?, movie = ?, nationality = ?, birthday = ? WHERE username = ?"
-
-            cursor = self.connection.execute(query, (education, employment, music, movie, nationality, birthday, username))
+            cursor = self.connection.execute(_Q_UPDATE_PROFILE, (education, employment, music, movie, nationality, birthday, username))
             cursor.close()
-            self.connection.commit()
 
             return True
 
@@ -306,42 +336,75 @@ class SQLite3:
             print(e)
             return False
 
-    def add_friend(self, u_id, f_id) -> bool:
-        try:
-            query = "INSERT INTO Friends (u_id, f_id) VALUES (?, ?)"
+    def add_friend(self, u_id, f_id) -> Optional[bool]:
+        """Adds f_id as a friend of u_id.
 
-            cursor = self.connection.execute(query, (u_id, f_id))
+        Returns True if the friend was added, False if they were already friends and None on error.
+        """
+        try:
+            cursor = self.connection.execute(_Q_ADD_FRIEND, (u_id, f_id))
+            added = cursor.rowcount > 0
             cursor.close()
-            self.connection.commit()
 
-            return True
+            return added
 
         except sqlite3.Error as e:
             print(e)
-            return False
+            return None
 
     def delete_all_users(self) -> bool:
+        """Deletes all users from the database, along with their posts, comments and friendships."""
         try:
-            query = "DELETE FROM Users"
-
-            cursor = self.connection.execute(query)
-            cursor.close()
-            self.connection.commit()
+            self.connection.executescript(_Q_DELETE_ALL_USERS)
 
             return True
 
         except sqlite3.Error as e:
             print(e)
+            if self.connection.in_transaction:
+                self.connection.rollback()
             return False
 
+    def _connect(self) -> sqlite3.Connection:
+        """Opens a new connection to the SQLite3 database with the connection pragmas applied.
+
+        The connection is in autocommit mode, so every statement commits on its own.
+        Statements that must be applied together have to be wrapped in BEGIN IMMEDIATE and COMMIT.
+        """
+        conn = sqlite3.connect(self._path, isolation_level=None, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.executescript(_PRAGMAS)
+        return conn
+
     def _init_database(self, schema: PathLike | str) -> None:
-        """Initializes the database with the supplied schema if it does not exist yet."""
+        """Initializes the database with the supplied schema if it does not exist yet.
+
+        The whole schema is applied in a single transaction.
+        """
         with current_app.open_resource(str(schema), mode="r") as file:
-            self.connection.executescript(file.read())
-            self.connection.commit()
+            self.connection.executescript(f"BEGIN IMMEDIATE;\n{file.read()}\nCOMMIT;")
+
+    def _migrate_database(self, migrations: PathLike | str) -> None:
+        """Applies the supplied idempotent migrations to an existing database in a single transaction."""
+        with current_app.open_resource(str(migrations), mode="r") as file:
+            self.connection.executescript(f"BEGIN IMMEDIATE;\n{file.read()}\nCOMMIT;")
+
+    def _close_pool(self) -> None:
+        """Closes every connection currently in the pool."""
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except Empty:
+                break
+            conn.close()
 
     def _close_connection(self, exception: Optional[BaseException] = None) -> None:
-        """Closes the connection to the database."""
-        conn = cast(sqlite3.Connection, getattr(g, "flask_sqlite3_connection", None))
+        """Returns the connection to the pool, or closes it if the pool is full."""
+        conn = cast(Optional[sqlite3.Connection], g.pop("flask_sqlite3_connection", None))
         if conn is not None:
-            conn.close()
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                self._pool.put_nowait(conn)
+            except Full:
+                conn.close()
@@ -0,0 +1,17 @@
+-- --
+-- Bring databases created from an older schema.sql up to date.
+-- Every statement must be idempotent, this file is run on each startup.
+-- --
+
+-- Not UNIQUE: older databases may already hold duplicate usernames, which would make the
+-- migration fail. Databases created from schema.sql get the unique index instead.
+CREATE INDEX IF NOT EXISTS idx_users_username ON Users(username);
+CREATE INDEX IF NOT EXISTS idx_friends_fid_uid ON Friends(f_id, u_id);
+CREATE INDEX IF NOT EXISTS idx_posts_uid_time ON Posts(u_id, creation_time DESC);
+CREATE INDEX IF NOT EXISTS idx_comments_pid_time ON Comments(p_id, creation_time DESC, id DESC);
+
+-- Friends(u_id, f_id) is already covered by the primary key
+DROP INDEX IF EXISTS idx_friends_uid_fid;
+
+-- Comments(p_id) is covered by idx_comments_pid_time
+DROP INDEX IF EXISTS idx_comments_pid;
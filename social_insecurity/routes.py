@@ -4,23 +4,101 @@ This file contains the routes for the application. It is imported by the social_
 It also contains the SQL queries used for communicating with the database.
 """
 
-from pathlib import Path
-
-from flask import current_app as app, session, request
+import os
+import secrets
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from uuid import uuid4
+
+from flask import current_app as app, g, session, request
 from flask import flash, jsonify, redirect, render_template, send_from_directory, url_for
 import time
 
+from cachetools import TTLCache
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from social_insecurity import Config, sqlite
+from social_insecurity import Config, cache, sqlite
 from social_insecurity.forms import CommentsForm, FriendsForm, IndexForm, PostForm, ProfileForm
 
 from typing import Optional
 
-last_post_times = {}
-upload_history = {}
-login_attempts = {}
+# Entries expire once they can no longer affect a rate limit, and the caches never grow past their maxsize.
+# TTLCache is not thread-safe, so every read-then-write on a cache holds its lock.
+last_post_times = TTLCache(maxsize=app.config["RATE_LIMIT_CACHE_SIZE"], ttl=app.config["COOLDOWN_MS"] / 1000)
+last_post_times_lock = Lock()
+upload_history = TTLCache(maxsize=app.config["RATE_LIMIT_CACHE_SIZE"], ttl=app.config["UPLOAD_WINDOW"])
+upload_history_lock = Lock()
+# Failed logins are tracked per existing account, and separately for usernames that don't exist.
+# Junk usernames only ever evict each other, so they can't push out a real account's lockout.
+login_attempts = TTLCache(maxsize=app.config["RATE_LIMIT_CACHE_SIZE"], ttl=app.config["LOGIN_COOLDOWN"])
+unknown_login_attempts = TTLCache(maxsize=app.config["RATE_LIMIT_CACHE_SIZE"], ttl=app.config["LOGIN_COOLDOWN"])
+login_attempts_lock = Lock()
+
+# Password hashing runs in C with the GIL released, so the pool spreads it across cores
+# while capping how many hashes can run at once
+password_executor = ThreadPoolExecutor(
+    max_workers=app.config["PASSWORD_HASH_WORKERS"], thread_name_prefix="password-hash"
+)
+
+# Checked instead of a real hash when the username does not exist, so unknown and known
+# usernames cost the same and count towards the same login attempt limit
+DUMMY_HASH = generate_password_hash(secrets.token_hex(16))
+
+def hash_password(password: str) -> str:
+    """Hashes the password on the password hashing pool.
+
+    Returns:
+        out (str): The salted password hash.
+    """
+    return password_executor.submit(generate_password_hash, password).result()
+
+def verify_password(pwhash: str, password: str) -> bool:
+    """Checks the password against the hash on the password hashing pool.
+
+    Returns:
+        out (bool): True if the password matches, False otherwise.
+    """
+    return password_executor.submit(check_password_hash, pwhash, password).result()
+
+def is_login_allowed(username: str, known: bool) -> bool:
+    """Checks if a login attempt for the username may be made.
+
+    params:
+        username: The username the login attempt is for.
+        known: True if the username belongs to an existing account.
+
+    Returns:
+        out (bool): False if the username is locked out, True otherwise.
+    """
+    attempts = login_attempts if known else unknown_login_attempts
+    with login_attempts_lock:
+        attempt = attempts.get(username)
+        return attempt is None or attempt["attempts"] < app.config["MAX_LOGIN_ATTEMPTS"]
+
+def record_login_attempt(username: str, known: bool, success: bool) -> None:
+    """Records the outcome of a login attempt for the username.
+
+    A full login_attempts cache never evicts a live lockout to make room, the failure goes untracked instead.
+    A full unknown_login_attempts cache evicts its least recently used entry as usual.
+    """
+    attempts = login_attempts if known else unknown_login_attempts
+    with login_attempts_lock:
+        if success:
+            attempts.pop(username, None)
+            return
+
+        attempt = attempts.get(username)
+        if known and attempt is None and attempts.currsize >= attempts.maxsize:
+            attempts.expire()
+            if attempts.currsize >= attempts.maxsize:
+                return
+
+        attempts[username] = {
+            "attempts": (attempt["attempts"] if attempt else 0) + 1,
+            "last_attempt": time.time()
+        }
 
 def is_logged_in() -> bool:
     """Checks if the user is logged in.
@@ -33,10 +111,58 @@ def is_logged_in() -> bool:
 def get_current_user_data() -> Optional[dict]:
     """Returns the current user's data from the database.
 
+    The result is cached for the rest of the request.
+
     Returns:
         out (dict): The user's data.
     """
-    return sqlite.get_user_data(id=session["user_id"])
+    if "_current_user" not in g:
+        g._current_user = sqlite.get_user_data(id=session["user_id"])
+    return g._current_user
+
+def get_user_data(username: str) -> Optional[dict]:
+    """Returns the data of the user with the given username from the database.
+
+    The result is cached for the rest of the request.
+
+    Returns:
+        out (dict): The user's data.
+    """
+    users = g.setdefault("_user_by_name", {})
+    if username not in users:
+        users[username] = sqlite.get_user_data(username)
+    return users[username]
+
+def forget_user_data(username: str) -> None:
+    """Drops the cached data of the user with the given username after it was changed."""
+    g.get("_user_by_name", {}).pop(username, None)
+    g.pop("_current_user", None)
+
+# The cache pickles its values and sqlite3.Row can't be pickled, so cached rows are stored as dicts
+
+@cache.memoize()
+def get_posts(u_id: int, before_ts: Optional[str], before_id: Optional[int]) -> list[dict]:
+    """Returns a page of posts in the user's stream, cached across requests.
+
+    Invalidated with cache.delete_memoized(get_posts) whenever posts, comments, friends or profiles change.
+    """
+    return [dict(row) for row in sqlite.get_posts(u_id, before_ts, before_id, app.config["POSTS_PER_PAGE"])]
+
+@cache.memoize()
+def get_comments(p_id: int, before_ts: Optional[str], before_id: Optional[int]) -> list[dict]:
+    """Returns a page of comments on the post, cached across requests.
+
+    Invalidated with cache.delete_memoized(get_comments) whenever comments or profiles change.
+    """
+    return [dict(row) for row in sqlite.get_comments(p_id, before_ts, before_id, app.config["COMMENTS_PER_PAGE"])]
+
+@cache.memoize()
+def get_friend_datas(u_id: int) -> list[dict]:
+    """Returns the data of the user's friends, cached across requests.
+
+    Invalidated with cache.delete_memoized(get_friend_datas) whenever friends or profiles change.
+    """
+    return [dict(row) for row in sqlite.get_friend_datas(u_id)]
 
 @app.before_request
 def rate_limit_post_requests():
@@ -49,13 +175,14 @@ def rate_limit_post_requests():
         user_id = request.remote_addr
     
     now = time.time() * 1000
-    last_time = last_post_times.get(user_id, 0)
-    if now - last_time < app.config["COOLDOWN_MS"]:
-        wait_time = int(app.config["COOLDOWN_MS"] - (now - last_time))
-        return jsonify({
-            "error": f"Rate limit: wait {wait_time}ms before next POST."
-        }), 429
-    last_post_times[user_id] = now
+    with last_post_times_lock:
+        last_time = last_post_times.get(user_id, 0)
+        if now - last_time < app.config["COOLDOWN_MS"]:
+            wait_time = int(app.config["COOLDOWN_MS"] - (now - last_time))
+            return jsonify({
+                "error": f"Rate limit: wait {wait_time}ms before next POST."
+            }), 429
+        last_post_times[user_id] = now
 
 @app.route("/", methods=["GET", "POST"])
 @app.route("/index", methods=["GET", "POST"])
@@ -84,30 +211,17 @@ def index():
             flash("Please fill out all fields!", category="warning")
             return redirect(url_for("index"))
 
-        user_password = sqlite.get_user_password(login_form.username.data)
-        user_id = sqlite.get_user_id(login_form.username.data)
+        user_id, user_password = sqlite.get_user_auth(login_form.username.data) or (None, DUMMY_HASH)
 
-        if user_password is None:
-            flash("Wrong username or password!", category="warning")
-        elif login_attempts.get(login_form.username.data, {}).get("attempts", 0) >= app.config["MAX_LOGIN_ATTEMPTS"]:
-            if login_attempts[login_form.username.data]["last_attempt"] + app.config["LOGIN_COOLDOWN"] > time.time():
-                flash("Too many login attempts, please try again later.", category="danger")
-            else:
-                login_attempts[login_form.username.data] = {
-                    "attempts": 0,
-                    "last_attempt": 0
-                }
-        elif not check_password_hash(user_password, login_form.password.data):
+        known = user_id is not None
+
+        if not is_login_allowed(login_form.username.data, known):
+            flash("Too many login attempts, please try again later.", category="danger")
+        elif not verify_password(user_password, login_form.password.data) or not known:
             flash("Wrong username or password!", category="warning")
-            login_attempts[login_form.username.data] = {
-                "attempts": login_attempts.get(login_form.username.data, {}).get("attempts", 0) + 1,
-                "last_attempt": time.time()
-            }
+            record_login_attempt(login_form.username.data, known, success=False)
         else:
-            login_attempts[login_form.username.data] = {
-                "attempts": 0,
-                "last_attempt": 0
-            }
+            record_login_attempt(login_form.username.data, known, success=True)
             session["user_id"] = user_id     # Store the user's ID in the session
             return redirect(url_for("stream", username=login_form.username.data))
 
@@ -116,8 +230,9 @@ def index():
             flash("Please fill out all fields!", category="warning")
             return redirect(url_for("index"))
 
-        pw_hash = generate_password_hash(register_form.password.data)
+        pw_hash = hash_password(register_form.password.data)
         ok = sqlite.create_user(register_form.username.data, register_form.first_name.data, register_form.last_name.data, pw_hash)
+        forget_user_data(register_form.username.data)
 
         if not ok:
             flash("Failed to create user!", category="warning")
@@ -142,7 +257,7 @@ def stream(username: str):
         return redirect(url_for("index"))
 
     post_form = PostForm()
-    user = sqlite.get_user_data(username)
+    user = get_user_data(username)
 
     if user is None or session["user_id"] != user["id"]:
         user_data = get_current_user_data()
@@ -154,39 +269,48 @@ def stream(username: str):
 
     if post_form.is_submitted():
 
-        filename = secure_filename(post_form.image.data.filename)
+        filename = secure_filename(post_form.image.data.filename) if post_form.image.data else ""
 
-        extension = Path(filename).suffix
-        if filename and extension not in app.config["ALLOWED_EXTENSIONS"]:
+        _, dot, extension = filename.rpartition(".")
+        extension = extension.lower()
+        if filename and (not dot or extension not in app.config["ALLOWED_EXTENSIONS"]):
             flash("Illegal file extension", category="warning")
             return redirect(url_for("stream", username=username))
 
-        if post_form.image.data:
+        if filename:
             # TODO: add to overleaf
             user_id = session["user_id"]
             now = time.time()
             
-            timestamps = upload_history.get(user_id, [])
-            timestamps = [t for t in timestamps if now - t < app.config["UPLOAD_WINDOW"]]
-            upload_limit = app.config["UPLOAD_LIMIT"]
-            if len(timestamps) >= upload_limit:
-                flash("Too many uploads, please try again later.", category="warning")
-                return redirect(url_for("stream", username=username))
-            timestamps.append(now)
-            upload_history[user_id] = timestamps
+            with upload_history_lock:
+                timestamps = upload_history.get(user_id, [])
+                timestamps = [t for t in timestamps if now - t < app.config["UPLOAD_WINDOW"]]
+                upload_limit = app.config["UPLOAD_LIMIT"]
+                if len(timestamps) >= upload_limit:
+                    flash("Too many uploads, please try again later.", category="warning")
+                    return redirect(url_for("stream", username=username))
+                timestamps.append(now)
+                upload_history[user_id] = timestamps
             
-            path = Path(app.instance_path) / app.config["UPLOADS_FOLDER_PATH"] / filename
-            post_form.image.data.save(path)
+            # Random names never collide, so an upload can't overwrite another one and is never modified
+            filename = f"{uuid4().hex}.{extension}"
+            path = os.path.join(app.config["_UPLOADS_DIR"], filename)
+            with open(path, "wb") as file:
+                shutil.copyfileobj(post_form.image.data.stream, file, length=1 << 20)
 
         ok = sqlite.create_post(user["id"], post_form.content.data, filename)
+        cache.delete_memoized(get_posts)
 
         if not ok:
             flash("Failed to create post!", category="warning")
 
         return redirect(url_for("stream", username=username))
 
-    posts = sqlite.get_posts(user["id"])
-    return render_template("stream.html", title="Stream", username=username, form=post_form, posts=posts)
+    posts = get_posts(user["id"], request.args.get("before"), request.args.get("before_id", type=int))
+    has_more = len(posts) == app.config["POSTS_PER_PAGE"]
+    return render_template(
+        "stream.html", title="Stream", username=username, form=post_form, posts=posts, has_more=has_more
+    )
 
 
 @app.route("/comments/<string:username>/<int:post_id>", methods=["GET", "POST"])
@@ -201,7 +325,7 @@ def comments(username: str, post_id: int):
         return redirect(url_for("index"))
 
     comments_form = CommentsForm()
-    user = sqlite.get_user_data(username)
+    user = get_user_data(username)
 
     if user is None or session["user_id"] != user["id"]:
         user_data = get_current_user_data()
@@ -212,12 +336,24 @@ def comments(username: str, post_id: int):
         return redirect(url_for("stream", username=user_data["username"]))
 
     if comments_form.is_submitted():
-        sqlite.create_comment(post_id, user["id"], comments_form.comment.data)
+        ok = sqlite.create_comment(post_id, user["id"], comments_form.comment.data)
+        cache.delete_memoized(get_comments)
+        cache.delete_memoized(get_posts)
+
+        if not ok:
+            flash("Failed to create comment!", category="warning")
 
     post = sqlite.get_post(post_id)
-    comments = sqlite.get_comments(post_id)
+    comments = get_comments(post_id, request.args.get("before"), request.args.get("before_id", type=int))
+    has_more = len(comments) == app.config["COMMENTS_PER_PAGE"]
     return render_template(
-        "comments.html", title="Comments", username=username, form=comments_form, post=post, comments=comments
+        "comments.html",
+        title="Comments",
+        username=username,
+        form=comments_form,
+        post=post,
+        comments=comments,
+        has_more=has_more,
     )
 
 
@@ -234,7 +370,7 @@ def friends(username: str):
         return redirect(url_for("index"))
 
     friends_form = FriendsForm()
-    user = sqlite.get_user_data(username)
+    user = get_user_data(username)
 
     if user is None or session["user_id"] != user["id"]:
         user_data = get_current_user_data()
@@ -245,25 +381,27 @@ def friends(username: str):
         return redirect(url_for("friends", username=user_data["username"]))
 
     if friends_form.is_submitted():
-        friend = sqlite.get_user_data(friends_form.username.data)
-        friends = sqlite.get_friends(user["id"])
+        friend = get_user_data(friends_form.username.data)
 
         if friend is None:
             flash("User does not exist!", category="warning")
         elif friend["id"] == user["id"]:
             flash("You cannot be friends with yourself!", category="warning")
-        elif friend["id"] in [friend["f_id"] for friend in friends]:
-            flash("You are already friends with this user!", category="warning")
         else:
-            ok = sqlite.add_friend(user["id"], friend["id"])
+            added = sqlite.add_friend(user["id"], friend["id"])
 
-            if not ok:
+            if added is None:
                 flash("Failed to add friend!", category="warning")
                 return redirect(url_for("friends", username=username))
 
-            flash("Friend successfully added!", category="success")
+            if not added:
+                flash("You are already friends with this user!", category="warning")
+            else:
+                cache.delete_memoized(get_friend_datas)
+                cache.delete_memoized(get_posts)
+                flash("Friend successfully added!", category="success")
 
-    friends = sqlite.get_friend_datas(user["id"])
+    friends = get_friend_datas(user["id"])
     return render_template("friends.html", title="Friends", username=username, friends=friends, form=friends_form)
 
 
@@ -280,7 +418,7 @@ def profile(username: str):
         return redirect(url_for("index"))
 
     profile_form = ProfileForm()
-    user = sqlite.get_user_data(username)
+    user = get_user_data(username)
 
     if user is None:
         return redirect(url_for("index"))
@@ -289,6 +427,10 @@ def profile(username: str):
 
     if profile_form.is_submitted() and is_current_user:
         ok = sqlite.update_profile(username, profile_form.education.data, profile_form.employment.data, profile_form.music.data, profile_form.movie.data, profile_form.nationality.data, profile_form.birthday.data)
+        forget_user_data(username)
+        cache.delete_memoized(get_posts)
+        cache.delete_memoized(get_comments)
+        cache.delete_memoized(get_friend_datas)
         
         if not ok:
             flash("Failed to update profile!", category="warning")
@@ -302,7 +444,12 @@ def profile(username: str):
 @app.route("/uploads/<string:filename>")
 def uploads(filename):
     """Provides an endpoint for serving uploaded files."""
-    return send_from_directory(Path(app.instance_path) / app.config["UPLOADS_FOLDER_PATH"], filename)
+    return send_from_directory(
+        app.config["_UPLOADS_DIR"],
+        filename,
+        conditional=True,
+        max_age=app.config["UPLOADS_MAX_AGE"],
+    )
 
 
 @app.route("/logout")
@@ -3,7 +3,7 @@
 -- --
 
 CREATE TABLE [Users] (
-  id INTEGER PRIMARY KEY,
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
   username VARCHAR,
   first_name VARCHAR,
   last_name VARCHAR,
@@ -31,7 +31,7 @@ CREATE TABLE [Friends](
   PRIMARY KEY(u_id, f_id),
   FOREIGN KEY (u_id) REFERENCES [Users](id),
   FOREIGN KEY (f_id) REFERENCES [Users](id)
-);
+) WITHOUT ROWID;
 
 CREATE TABLE [Comments](
   id INTEGER PRIMARY KEY,
@@ -43,6 +43,15 @@ CREATE TABLE [Comments](
   FOREIGN KEY (u_id) REFERENCES Users(id)
 );
 
+-- --
+-- Create indexes
+-- --
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username ON Users(username);
+CREATE INDEX IF NOT EXISTS idx_friends_fid_uid ON Friends(f_id, u_id);
+CREATE INDEX IF NOT EXISTS idx_posts_uid_time ON Posts(u_id, creation_time DESC);
+CREATE INDEX IF NOT EXISTS idx_comments_pid_time ON Comments(p_id, creation_time DESC, id DESC);
+
 -- --
 -- Populate tables with test data
 -- --
@@ -1,11 +1,12 @@
 from __future__ import annotations
 
+import re
 from collections.abc import Iterator
 from typing import TYPE_CHECKING
 
 import pytest
 
-from social_insecurity import create_app
+from social_insecurity import cache, create_app, sqlite
 
 if TYPE_CHECKING:
     from flask import Flask
@@ -13,9 +14,12 @@ if TYPE_CHECKING:
 
 
 @pytest.fixture(scope="session")
-def app() -> Iterator[Flask]:
+def app(tmp_path_factory: pytest.TempPathFactory) -> Iterator[Flask]:
+    tmp_path = tmp_path_factory.mktemp("instance")
     test_config = {
-        "SQLITE3_DATABASE_PATH": "file::memory:?cache=shared",
+        # Absolute paths replace the instance folder, so tests never touch ./instance
+        "SQLITE3_DATABASE_PATH": str(tmp_path / "db" / "sqlite3.db"),
+        "UPLOADS_FOLDER_PATH": str(tmp_path / "uploads"),
         "TESTING": True,
         "WTF_CSRF_ENABLED": False,
     }
@@ -31,3 +35,80 @@ def client(app: Flask) -> FlaskClient:
 def test_request_index(client: FlaskClient):
     response = client.get("/")
     assert response.status_code == 200
+
+
+def test_login_unknown_user(client: FlaskClient):
+    response = client.post(
+        "/",
+        data={"login-username": "nobody", "login-password": "secret", "login-submit": "Sign In"},
+    )
+    assert response.status_code == 200
+    assert b"Wrong username or password!" in response.data
+
+
+def test_stream_pagination(app: Flask, client: FlaskClient):
+    username = "pager"
+    with app.app_context():
+        sqlite.create_user(username, "Page", "R", "unused")
+        user_id = sqlite.get_user_auth(username)[0]
+        for i in range(5):
+            # Equal creation times, so only the id cursor keeps the pages apart
+            sqlite.connection.execute(
+                "INSERT INTO Posts (u_id, content, creation_time) VALUES (?, ?, '2024-01-01 00:00:00')",
+                (user_id, f"page-post-{i}"),
+            )
+        cache.clear()
+
+    with client.session_transaction() as session:
+        session["user_id"] = user_id
+
+    posts_per_page = app.config["POSTS_PER_PAGE"]
+    app.config["POSTS_PER_PAGE"] = 2
+    try:
+        pages = []
+        url = f"/stream/{username}"
+        while url:
+            html = client.get(url).get_data(as_text=True)
+            pages.append(re.findall(r"page-post-\d", html))
+            match = re.search(r"href=(\S+)>Load more", html)
+            url = match.group(1).replace("&amp;", "&") if match else None
+    finally:
+        app.config["POSTS_PER_PAGE"] = posts_per_page
+
+    assert pages == [["page-post-4", "page-post-3"], ["page-post-2", "page-post-1"], ["page-post-0"]]
+
+
+def test_login_lockout_survives_junk_usernames(app: Flask, monkeypatch: pytest.MonkeyPatch):
+    from cachetools import TTLCache
+
+    import social_insecurity.routes as routes
+
+    ttl = app.config["LOGIN_COOLDOWN"]
+    monkeypatch.setattr(routes, "login_attempts", TTLCache(maxsize=3, ttl=ttl))
+    monkeypatch.setattr(routes, "unknown_login_attempts", TTLCache(maxsize=3, ttl=ttl))
+    with app.app_context():
+        for _ in range(app.config["MAX_LOGIN_ATTEMPTS"]):
+            routes.record_login_attempt("target", known=True, success=False)
+        assert not routes.is_login_allowed("target", known=True)
+
+        # Failed logins for more junk usernames than the caches hold
+        for i in range(10):
+            routes.record_login_attempt(f"junk-{i}", known=False, success=False)
+
+        assert not routes.is_login_allowed("target", known=True)
+        assert routes.is_login_allowed("alice", known=True)
+        assert routes.is_login_allowed("junk-10", known=False)
+
+
+def test_text_only_post(app: Flask, client: FlaskClient):
+    with app.app_context():
+        sqlite.create_user("writer", "Text", "Only", "unused")
+        user_id = sqlite.get_user_auth("writer")[0]
+        cache.clear()
+
+    with client.session_transaction() as session:
+        session["user_id"] = user_id
+
+    response = client.post("/stream/writer", data={"content": "no image here", "submit": "Post"})
+    assert response.status_code == 302
+    assert b"no image here" in client.get("/stream/writer").data